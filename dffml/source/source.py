@@ -4,7 +4,9 @@
 Source subclasses are responsible for generating an integer value given an open
 source project's source URL.
 """
+
 import abc
+import asyncio
 import unittest
 from typing import AsyncIterator, List, Optional, Callable
 
@@ -148,12 +150,16 @@ class SourcesContext(AsyncContextManagerListContext):
         """
         Retrieves records from all sources
         """
+        # NOTE In Python 3.7.3 self[1:] works, however in Python >
+        # 3.7.3 only self.data works
+        other_sources = self.data[1:]
         for source in self:
             async for record in source.records():
-                # NOTE In Python 3.7.3 self[1:] works, however in Python >
-                # 3.7.3 only self.data works
-                for other_source in self.data[1:]:
-                    record.merge(await other_source.record(record.key))
+                if other_sources:
+                    for other_record in await self._lookup(
+                        other_sources, record.key
+                    ):
+                        record.merge(other_record)
                 if validation is None or validation(record):
                     yield record
             break
@@ -163,10 +169,35 @@ class SourcesContext(AsyncContextManagerListContext):
         Retrieve and or register record will all sources
         """
         record = Record(key)
-        for source in self:
-            record.merge(await source.record(key))
+        for source_record in await self._lookup(self.data, key):
+            record.merge(source_record)
         return record
 
+    @staticmethod
+    async def _lookup(sources, key: str) -> List[Record]:
+        """
+        Look up a record in each of the given sources. When there is more than
+        one lookup they run concurrently, so that we wait on the I/O of every
+        source at the same time. A single lookup is awaited directly, since
+        gather would only add the overhead of wrapping it in a Task.
+        Results are in the same order as the sources. If any lookup raises,
+        the rest are cancelled and the first exception is re-raised.
+        """
+        if len(sources) < 2:
+            return [await source.record(key) for source in sources]
+        tasks = [
+            asyncio.ensure_future(source.record(key)) for source in sources
+        ]
+        try:
+            return await asyncio.gather(*tasks)
+        except Exception:
+            for task in tasks:
+                task.cancel()
+            # Wait for the cancelled lookups to finish and retrieve any other
+            # exceptions so they aren't reported as never retrieved
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
     async def with_features(
         self, features: List[str]
     ) -> AsyncIterator[Record]:
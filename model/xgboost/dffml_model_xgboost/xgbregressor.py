@@ -1,14 +1,12 @@
 # Co-authored-by: Oliver O'Brien <oliverobrien111@gmail.com>
 # Co-authored-by: John Andersen <johnandersenpdx@gmail.com>
 # Co-authored-by: Soren Andersen <sorenpdx@gmail.com>
+import os
 import pathlib
-from typing import AsyncIterator
+import operator
+from typing import AsyncIterator, Tuple
 
-import joblib
 import numpy as np
-import pandas as pd
-import xgboost as xgb
-from sklearn.metrics import r2_score
 
 from dffml.record import Record
 from dffml.base import config, field
@@ -18,6 +16,14 @@ from dffml.util.entrypoint import entrypoint
 from dffml.feature.feature import Feature, Features
 from dffml.model.model import SimpleModel, ModelNotTrained
 
+# Data type of all arrays handed to xgboost. xgboost works in float32
+# internally, anything wider is converted (and copied) on the way in.
+MATRIX_DTYPE = np.float32
+# Number of records converted at a time when streaming records from a source
+STREAM_CHUNK_SIZE = 4096
+# xgboost doesn't give a confidence for regression predictions
+NAN = float("nan")
+
 
 @config
 class XGBRegressorModelConfig:
@@ -38,7 +44,16 @@ class XGBRegressorModelConfig:
         default=0,
     )
     n_jobs: int = field(
-        "Number of parallel threads used to run xgboost", default=-1
+        "Number of parallel threads used to run xgboost",
+        default=max(1, (os.cpu_count() or 1) - 1),
+    )
+    tree_method: str = field(
+        "Tree construction algorithm: auto, exact, approx or hist",
+        default="hist",
+    )
+    max_bin: int = field(
+        "Maximum number of bins features are bucketed into when tree_method is hist",
+        default=256,
     )
     colsample_bytree: float = field(
         "Subsample ratio of columns when constructing each tree", default=1
@@ -58,6 +73,22 @@ class XGBRegressorModelConfig:
         "L1 regularization term on weights. Increasing this value will make model more conservative",
         default=0,
     )
+    early_stopping_rounds: int = field(
+        "Stop training once the score on the validation set hasn't improved for this many rounds. 0 trains all n_estimators rounds",
+        default=0,
+    )
+    validation_size: float = field(
+        "Fraction of the training data held out to check for early stopping",
+        default=0.1,
+    )
+    validation_seed: int = field(
+        "Seed for randomly picking the validation set, so that training on the same data gives the same model",
+        default=0,
+    )
+    gpu: bool = field(
+        "Train and predict on the GPU. Uses the hist tree method with device cuda on xgboost 2 and later, and the gpu_hist tree method with gpu_predictor on xgboost 1.x. tree_method is ignored when this is set",
+        default=False,
+    )
 
 
 @entrypoint("xgbregressor")
@@ -88,32 +119,59 @@ class XGBRegressorModel(SimpleModel):
         super().__init__(config)
         # The saved model
         self.saved = None
-        self.saved_filepath = pathlib.Path(
-            self.config.directory, "model.joblib"
+        self.saved_filepath = pathlib.Path(self.config.directory, "model.json")
+        # Lay out the columns of the matrices passed to xgboost. Features are
+        # placed in the same (sorted) order as self.features, each taking up
+        # as many columns as its length.
+        features_by_name = {
+            feature.name: feature for feature in self.config.features
+        }
+        lengths = [features_by_name[name].length for name in self.features]
+        offsets = np.cumsum([0] + lengths)
+        self._columns = tuple(
+            (name, slice(int(start), int(stop)))
+            for name, start, stop in zip(
+                self.features, offsets[:-1], offsets[1:]
+            )
         )
+        self._n_cols = int(offsets[-1])
+        # Features records need to have for training or assessing accuracy
+        self._train_feature_names = self.features + [self.config.predict.name]
         # Load saved model if it exists
         if self.saved_filepath.is_file():
-            self.saved = joblib.load(str(self.saved_filepath))
+            import xgboost as xgb
+
+            self.saved = xgb.XGBRegressor()
+            self.saved.load_model(str(self.saved_filepath))
+            if self.config.gpu:
+                # Only switch where predictions are made, the trees are built
+                device_params = self._device_params(xgb)
+                del device_params["tree_method"]
+                self.saved.set_params(**device_params)
 
     async def train(self, sources: Sources) -> None:
         """
         Trains and saves a model using the source data, and the config attributes
         """
+        import xgboost as xgb
+
         # Get data into memory
-        xdata = []
-        ydata = []
-        async for record in sources.with_features(
-            self.features + [self.parent.config.predict.name]
-        ):
-            record_data = []
-            for feature in record.features(self.features).values():
-                record_data.extend(
-                    [feature] if np.isscalar(feature) else feature
-                )
-            xdata.append(record_data)
-            ydata.append(record.feature(self.parent.config.predict.name))
-        x_data = pd.DataFrame(xdata)
-        y_data = pd.DataFrame(ydata)
+        x_data, y_data = await self._stream_Xy(
+            sources.with_features(self._train_feature_names)
+        )
+
+        # Hold out part of the training data to know when to stop adding trees
+        fit_params = {}
+        if self.config.early_stopping_rounds:
+            from sklearn.model_selection import train_test_split
+
+            x_data, x_val, y_data, y_val = train_test_split(
+                x_data,
+                y_data,
+                test_size=self.config.validation_size,
+                random_state=self.config.validation_seed,
+            )
+            fit_params["eval_set"] = [(x_val, y_val)]
 
         self.saved = xgb.XGBRegressor(
             n_estimators=self.config.n_estimators,
@@ -122,17 +180,24 @@ class XGBRegressorModel(SimpleModel):
             subsample=self.config.subsample,
             gamma=self.config.gamma,
             n_jobs=self.config.n_jobs,
+            max_bin=self.config.max_bin,
             colsample_bytree=self.config.colsample_bytree,
             booster=self.config.booster,
             min_child_weight=self.config.min_child_weight,
             reg_lambda=self.config.reg_lambda,
             reg_alpha=self.config.reg_alpha,
+            early_stopping_rounds=self.config.early_stopping_rounds or None,
+            **self._device_params(xgb),
         )
 
-        self.saved.fit(x_data, y_data)
+        # On xgboost 1.7 and later, tree boosters using the hist or gpu_hist
+        # tree methods have fit() load x_data into a QuantileDMatrix, which
+        # bins each feature once up front and stores bin indexes instead of
+        # float values. Older versions and gblinear use a full DMatrix.
+        self.saved.fit(x_data, y_data, verbose=False, **fit_params)
 
         # Save the trained model
-        joblib.dump(self.saved, str(self.saved_filepath))
+        self.saved.save_model(str(self.saved_filepath))
 
     async def accuracy(self, sources: Sources) -> Accuracy:
         """
@@ -144,25 +209,15 @@ class XGBRegressorModel(SimpleModel):
         if not self.saved:
             raise ModelNotTrained("Train the model before assessing accuracy")
 
-        # Get data
-        input_data = await self.get_input_data(sources)
+        from sklearn.metrics import r2_score
 
-        # Make predictions
-        xdata = []
-        for record in input_data:
-            record_data = []
-            for feature in record.features(self.features).values():
-                record_data.extend(
-                    [feature] if np.isscalar(feature) else feature
-                )
-            xdata.append(record_data)
-
-        predictions = self.saved.predict(pd.DataFrame(xdata))
+        # Get the features and the actual values in a single pass
+        x_data, actuals = await self._stream_Xy(
+            sources.with_features(self._train_feature_names)
+        )
 
-        actuals = [
-            input_datum.feature(self.config.predict.name)
-            for input_datum in input_data
-        ]
+        # Make predictions
+        predictions = self.saved.predict(x_data)
 
         return r2_score(actuals, predictions)
 
@@ -177,27 +232,118 @@ class XGBRegressorModel(SimpleModel):
         # Grab records and input data (X data)
         input_data = await self.get_input_data(sources)
         # Make predictions
-        xdata = []
-        for record in input_data:
-            record_data = []
-            for feature in record.features(self.features).values():
-                record_data.extend(
-                    [feature] if np.isscalar(feature) else feature
-                )
-            xdata.append(record_data)
-
-        predictions = self.saved.predict(pd.DataFrame(xdata))
-        # Update records and yield them to caller
-        for record, prediction in zip(input_data, predictions):
-            record.predicted(
-                self.config.predict.name, float(prediction), float("nan")
-            )
+        predictions = self.saved.predict(self._build_X(input_data))
+        # Update records and yield them to caller. tolist() converts all the
+        # predictions to Python floats in one go.
+        for record, prediction in zip(input_data, predictions.tolist()):
+            record.predicted(self.config.predict.name, prediction, NAN)
             yield record
 
     async def get_input_data(self, sources: Sources) -> list:
         saved_records = []
-        async for record in sources.with_features(
-            self.config.features.names()
-        ):
+        async for record in sources.with_features(self.features):
             saved_records.append(record)
         return saved_records
+
+    def _device_params(self, xgb) -> dict:
+        """
+        Parameters for xgboost's tree method and the device trees are built
+        and predictions are made on. xgboost 2 replaced the gpu_hist tree
+        method and gpu_predictor with the device parameter.
+        """
+        if not self.config.gpu:
+            return {"tree_method": self.config.tree_method}
+        if int(xgb.__version__.split(".")[0]) >= 2:
+            return {"tree_method": "hist", "device": "cuda"}
+        return {"tree_method": "gpu_hist", "predictor": "gpu_predictor"}
+
+    def _build_X(self, records) -> np.ndarray:
+        """
+        Pack the values of the model's features from each record into a single
+        ``MATRIX_DTYPE`` matrix with one row per record. Columns are laid out in
+        the order of ``self.features``, each feature taking up
+        ``feature.length`` columns.
+        """
+        X = np.empty((len(records), self._n_cols), dtype=MATRIX_DTYPE)
+        # Records store their features as a dict per record. Grab each dict
+        # once, then pull out a column of values for every feature with
+        # itemgetter, so that the transpose from rows to columns happens in C
+        # rather than via a Record.feature() call for every value.
+        records_features = [record.features() for record in records]
+        # Fill the matrix one feature at a time. Converting all the values
+        # for a feature with a single call to numpy lets it do the
+        # flattening of vector features in C, instead of looping in Python
+        # over every value of every record.
+        for name, columns_slice in self._columns:
+            values = list(map(operator.itemgetter(name), records_features))
+            length = columns_slice.stop - columns_slice.start
+            try:
+                column = np.asarray(values, dtype=MATRIX_DTYPE).reshape(
+                    len(records), length
+                )
+            except ValueError as error:
+                # Records may store the same feature differently, for instance
+                # a bare scalar in some and a one element list in others.
+                # Flatten each value on its own, then make sure they all have
+                # the declared length.
+                values = [np.ravel(value) for value in values]
+                for record, value in zip(records, values):
+                    if value.size != length:
+                        raise ValueError(
+                            f"Feature {name!r} was declared with length "
+                            f"{length} but record {record.key!r} has a value "
+                            f"of length {value.size}"
+                        ) from error
+                column = np.asarray(values, dtype=MATRIX_DTYPE)
+            X[:, columns_slice] = column
+        return X
+
+    def _build_Xy(self, records) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Same as :py:meth:`_build_X` but also returns the vector of values of
+        the feature being predicted.
+        """
+        predict_name = self.parent.config.predict.name
+        y = np.array(
+            [record.feature(predict_name) for record in records],
+            dtype=MATRIX_DTYPE,
+        )
+        return self._build_X(records), y
+
+    async def _stream_Xy(
+        self, records: AsyncIterator[Record]
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Same as :py:meth:`_build_Xy` but consumes an async iterator of records
+        without keeping all of them in memory. Records are converted
+        ``STREAM_CHUNK_SIZE`` at a time and written into buffers which double
+        in size whenever they fill up.
+        """
+        X = np.empty((STREAM_CHUNK_SIZE, self._n_cols), dtype=MATRIX_DTYPE)
+        y = np.empty(STREAM_CHUNK_SIZE, dtype=MATRIX_DTYPE)
+        n_rows = 0
+        chunk = []
+
+        def flush():
+            nonlocal X, y, n_rows
+            if n_rows + len(chunk) > X.shape[0]:
+                grown_X = np.empty(
+                    (2 * X.shape[0], self._n_cols), dtype=MATRIX_DTYPE
+                )
+                grown_X[:n_rows] = X[:n_rows]
+                grown_y = np.empty(2 * y.shape[0], dtype=MATRIX_DTYPE)
+                grown_y[:n_rows] = y[:n_rows]
+                X, y = grown_X, grown_y
+            chunk_X, chunk_y = self._build_Xy(chunk)
+            X[n_rows : n_rows + len(chunk)] = chunk_X
+            y[n_rows : n_rows + len(chunk)] = chunk_y
+            n_rows += len(chunk)
+            chunk.clear()
+
+        async for record in records:
+            chunk.append(record)
+            if len(chunk) == STREAM_CHUNK_SIZE:
+                flush()
+        if chunk:
+            flush()
+        return X[:n_rows], y[:n_rows]
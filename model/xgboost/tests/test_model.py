@@ -1,10 +1,13 @@
 import os
 import sys
 import random
+import pathlib
 import tempfile
 import subprocess
+from unittest.mock import patch
 
 import numpy as np
+import xgboost
 
 from dffml.record import Record
 from dffml.base import config, field
@@ -103,3 +106,174 @@ class TestXGBRegressor(AsyncTestCase):
             "diabetesregression.py",
         )
         subprocess.check_call([sys.executable, filepath])
+
+    async def test_04_early_stopping(self):
+        # Seeded data with noisy targets, so that the score on the (seeded)
+        # validation set stops improving well before n_estimators rounds
+        random_state = np.random.RandomState(42)
+        _temp_data = random_state.rand(2000, 2)
+        _noise = random_state.normal(0, 0.05, 2000)
+        records = [
+            Record(
+                str(i),
+                data={
+                    "features": {
+                        "Feature1": float(_temp_data[i][0]),
+                        "Feature2": float(_temp_data[i][1]),
+                        "Target": float(
+                            2 * _temp_data[i][0]
+                            + 3 * _temp_data[i][1]
+                            + _noise[i]
+                        ),
+                    }
+                },
+            )
+            for i in range(2000)
+        ]
+        with tempfile.TemporaryDirectory() as model_dir:
+            model = XGBRegressorModel(
+                XGBRegressorModelConfig(
+                    features=Features(
+                        Feature("Feature1", float, 1), Feature("Feature2")
+                    ),
+                    predict=Feature("Target", float, 1),
+                    directory=model_dir,
+                    learning_rate=0.3,
+                    early_stopping_rounds=10,
+                    validation_seed=0,
+                )
+            )
+            await train(
+                model,
+                Sources(
+                    MemorySource(MemorySourceConfig(records=records[:1800]))
+                ),
+            )
+            # Training should have stopped before building every tree
+            self.assertLess(
+                model.saved.best_iteration, model.config.n_estimators - 1
+            )
+            # Without losing accuracy
+            res = await accuracy(
+                model,
+                Sources(
+                    MemorySource(MemorySourceConfig(records=records[1800:]))
+                ),
+            )
+            self.assertTrue(0.8 <= res)
+
+    async def test_05_gpu_params(self):
+        for version, device_params in [
+            (
+                "1.7.6",
+                {"tree_method": "gpu_hist", "predictor": "gpu_predictor"},
+            ),
+            ("2.0.0", {"tree_method": "hist", "device": "cuda"}),
+        ]:
+            with self.subTest(version=version), patch.object(
+                xgboost, "__version__", version
+            ), patch.object(
+                xgboost, "XGBRegressor"
+            ) as regressor, tempfile.TemporaryDirectory() as model_dir:
+                model = XGBRegressorModel(
+                    XGBRegressorModelConfig(
+                        features=Features(
+                            Feature("Feature1", float, 1), Feature("Feature2")
+                        ),
+                        predict=Feature("Target", float, 1),
+                        directory=model_dir,
+                        gpu=True,
+                    )
+                )
+                # Trees are built on the GPU
+                await train(model, self.trainingsource)
+                _, kwargs = regressor.call_args
+                for key, value in device_params.items():
+                    self.assertEqual(kwargs[key], value)
+                # Saved models are switched to the GPU when loaded
+                regressor.reset_mock()
+                pathlib.Path(model_dir, "model.json").touch()
+                model = XGBRegressorModel(model.config)
+                del device_params["tree_method"]
+                regressor.return_value.set_params.assert_called_once_with(
+                    **device_params
+                )
+
+    def test_06_feature_length_mismatch(self):
+        record = Record(
+            "mismatch",
+            data={"features": {"Feature1": [0.1, 0.2], "Feature2": 1}},
+        )
+        with self.assertRaisesRegex(
+            ValueError,
+            "Feature 'Feature1' was declared with length 1 but record "
+            "'mismatch' has a value of length 2",
+        ):
+            self.model._build_X(self.records[:5] + [record])
+
+    async def test_07_vector_feature(self):
+        # Declared in the opposite order to the sorted order the model uses
+        features = Features(Feature("Vector", float, 2), Feature("Scalar"))
+        _temp_data = np.random.rand(1000, 3)
+        records = [
+            Record(
+                str(i),
+                data={
+                    "features": {
+                        "Vector": list(map(float, row[:2])),
+                        "Scalar": float(row[2]),
+                        "Target": float(row[0] + 2 * row[1] + 3 * row[2]),
+                    }
+                },
+            )
+            for i, row in enumerate(_temp_data)
+        ]
+        with tempfile.TemporaryDirectory() as model_dir:
+            model = XGBRegressorModel(
+                XGBRegressorModelConfig(
+                    features=features,
+                    predict=Feature("Target", float, 1),
+                    directory=model_dir,
+                )
+            )
+            # Columns follow the sorted order of the features, vectors are
+            # flattened into as many columns as their length
+            self.assertEqual(model.features, ["Scalar", "Vector"])
+            X = model._build_X(records)
+            self.assertEqual(X.shape, (1000, 3))
+            np.testing.assert_allclose(X[:, 0], _temp_data[:, 2], rtol=1e-6)
+            np.testing.assert_allclose(X[:, 1:], _temp_data[:, :2], rtol=1e-6)
+            # Train and predict using the vector feature
+            trainingsource = Sources(
+                MemorySource(MemorySourceConfig(records=records[:900]))
+            )
+            testsource = Sources(
+                MemorySource(MemorySourceConfig(records=records[900:]))
+            )
+            await train(model, trainingsource)
+            self.assertTrue(0.8 <= await accuracy(model, testsource))
+            predictions = [
+                prediction["Target"]["value"]
+                async for _, _, prediction in predict(model, testsource)
+            ]
+            self.assertEqual(len(predictions), 100)
+
+    def test_08_mixed_scalar_and_sequence_values(self):
+        # The same length 1 feature as a bare scalar in some records and a
+        # one element list in others
+        records = [
+            Record(
+                str(i),
+                data={
+                    "features": {
+                        "Feature1": [float(i)] if i % 2 else float(i),
+                        "Feature2": i,
+                    }
+                },
+            )
+            for i in range(4)
+        ]
+        np.testing.assert_array_equal(
+            self.model._build_X(records),
+            [[0, 0], [1, 1], [2, 2], [3, 3]],
+        )
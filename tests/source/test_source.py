@@ -0,0 +1,139 @@
+import asyncio
+
+from dffml.record import Record
+from dffml.source.source import Sources
+from dffml.source.memory import (
+    MemorySource,
+    MemorySourceConfig,
+    MemorySourceContext,
+)
+from dffml.util.asynctestcase import AsyncTestCase
+
+
+class LookupFailed(Exception):
+    pass
+
+
+class SlowSourceContext(MemorySourceContext):
+    async def record(self, key: str) -> Record:
+        lookups = self.parent.lookups
+        lookups["started"] += 1
+        # Only return once every source's lookup has started. If lookups ran
+        # one after another the first one would never see the others start.
+        if lookups["started"] == lookups["sources"]:
+            lookups["all_started"].set()
+        try:
+            if self.parent.fail:
+                raise LookupFailed(key)
+            await asyncio.wait_for(lookups["all_started"].wait(), timeout=1)
+        except asyncio.CancelledError:
+            lookups["cancelled"] += 1
+            raise
+        return await super().record(key)
+
+
+class SlowSource(MemorySource):
+    CONTEXT = SlowSourceContext
+
+
+class TestSources(AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        self.sources = Sources(
+            MemorySource(
+                MemorySourceConfig(
+                    records=[
+                        Record("0", data={"features": {"a": 0}}),
+                        Record("1", data={"features": {"a": 1}}),
+                    ]
+                )
+            ),
+            MemorySource(
+                MemorySourceConfig(
+                    records=[Record("0", data={"features": {"b": 10}})]
+                )
+            ),
+            MemorySource(
+                MemorySourceConfig(
+                    records=[
+                        Record("0", data={"features": {"b": 20, "c": 30}}),
+                        Record("1", data={"features": {"c": 31}}),
+                    ]
+                )
+            ),
+        )
+
+    async def test_records_merged(self):
+        async with self.sources as sources:
+            async with sources() as sctx:
+                records = {
+                    record.key: record.features()
+                    async for record in sctx.records()
+                }
+        self.assertEqual(
+            records,
+            {"0": {"a": 0, "b": 10, "c": 30}, "1": {"a": 1, "c": 31}},
+        )
+
+    async def test_record_merged(self):
+        async with self.sources as sources:
+            async with sources() as sctx:
+                record = await sctx.record("0")
+        self.assertEqual(record.features(), {"a": 0, "b": 10, "c": 30})
+
+
+class TestSourcesConcurrentLookups(AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        self.lookups = {
+            "sources": 2,
+            "started": 0,
+            "cancelled": 0,
+            "all_started": asyncio.Event(),
+        }
+
+    def slow_source(self, value, fail=False):
+        source = SlowSource(
+            MemorySourceConfig(
+                records=[Record("0", data={"features": {"a": value}})]
+            )
+        )
+        source.lookups = self.lookups
+        source.fail = fail
+        return source
+
+    async def test_record_lookups_overlap(self):
+        async with Sources(
+            self.slow_source(0), self.slow_source(1)
+        ) as sources:
+            async with sources() as sctx:
+                record = await sctx.record("0")
+        self.assertEqual(record.features(), {"a": 0})
+        self.assertEqual(self.lookups["started"], 2)
+
+    async def test_records_lookups_overlap(self):
+        first = MemorySource(
+            MemorySourceConfig(
+                records=[Record("0", data={"features": {"b": 0}})]
+            )
+        )
+        async with Sources(
+            first, self.slow_source(1), self.slow_source(2)
+        ) as sources:
+            async with sources() as sctx:
+                records = [
+                    record.features() async for record in sctx.records()
+                ]
+        self.assertEqual(records, [{"a": 1, "b": 0}])
+        self.assertEqual(self.lookups["started"], 2)
+
+    async def test_failed_lookup_cancels_others(self):
+        # The failing source never lets the other lookup finish on its own
+        self.lookups["sources"] = 3
+        async with Sources(
+            self.slow_source(0), self.slow_source(1, fail=True)
+        ) as sources:
+            async with sources() as sctx:
+                with self.assertRaises(LookupFailed):
+                    await sctx.record("0")
+        self.assertEqual(self.lookups["cancelled"], 1)